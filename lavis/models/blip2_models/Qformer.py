@@ -201,67 +201,88 @@ class BertSelfAttention(nn.Module):
 
         past_key_value = (key_layer, value_layer)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+        # the fused kernels do not expose the attention probabilities, so keep the
+        # explicit computation whenever they are needed or positions are relative
+        use_sdpa = (
+            hasattr(F, "scaled_dot_product_attention")
+            and self.position_embedding_type == "absolute"
+            and head_mask is None
+            and not output_attentions
+            and not (is_cross_attention and self.save_attention)
+        )
 
-        if (
-            self.position_embedding_type == "relative_key"
-            or self.position_embedding_type == "relative_key_query"
-        ):
-            seq_length = hidden_states.size()[1]
-            position_ids_l = torch.arange(
-                seq_length, dtype=torch.long, device=hidden_states.device
-            ).view(-1, 1)
-            position_ids_r = torch.arange(
-                seq_length, dtype=torch.long, device=hidden_states.device
-            ).view(1, -1)
-            distance = position_ids_l - position_ids_r
-            positional_embedding = self.distance_embedding(
-                distance + self.max_position_embeddings - 1
+        if use_sdpa:
+            if attention_mask is not None:
+                attention_mask = attention_mask.to(query_layer.dtype)
+            context_layer = F.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
             )
-            positional_embedding = positional_embedding.to(
-                dtype=query_layer.dtype
-            )  # fp16 compatibility
-
-            if self.position_embedding_type == "relative_key":
-                relative_position_scores = torch.einsum(
-                    "bhld,lrd->bhlr", query_layer, positional_embedding
-                )
-                attention_scores = attention_scores + relative_position_scores
-            elif self.position_embedding_type == "relative_key_query":
-                relative_position_scores_query = torch.einsum(
-                    "bhld,lrd->bhlr", query_layer, positional_embedding
-                )
-                relative_position_scores_key = torch.einsum(
-                    "bhrd,lrd->bhlr", key_layer, positional_embedding
-                )
-                attention_scores = (
-                    attention_scores
-                    + relative_position_scores_query
-                    + relative_position_scores_key
+        else:
+            # Take the dot product between "query" and "key" to get the raw attention scores.
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+
+            if (
+                self.position_embedding_type == "relative_key"
+                or self.position_embedding_type == "relative_key_query"
+            ):
+                seq_length = hidden_states.size()[1]
+                position_ids_l = torch.arange(
+                    seq_length, dtype=torch.long, device=hidden_states.device
+                ).view(-1, 1)
+                position_ids_r = torch.arange(
+                    seq_length, dtype=torch.long, device=hidden_states.device
+                ).view(1, -1)
+                distance = position_ids_l - position_ids_r
+                positional_embedding = self.distance_embedding(
+                    distance + self.max_position_embeddings - 1
                 )
+                positional_embedding = positional_embedding.to(
+                    dtype=query_layer.dtype
+                )  # fp16 compatibility
 
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        if attention_mask is not None:
-            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-            attention_scores = attention_scores + attention_mask
+                if self.position_embedding_type == "relative_key":
+                    relative_position_scores = torch.einsum(
+                        "bhld,lrd->bhlr", query_layer, positional_embedding
+                    )
+                    attention_scores = attention_scores + relative_position_scores
+                elif self.position_embedding_type == "relative_key_query":
+                    relative_position_scores_query = torch.einsum(
+                        "bhld,lrd->bhlr", query_layer, positional_embedding
+                    )
+                    relative_position_scores_key = torch.einsum(
+                        "bhrd,lrd->bhlr", key_layer, positional_embedding
+                    )
+                    attention_scores = (
+                        attention_scores
+                        + relative_position_scores_query
+                        + relative_position_scores_key
+                    )
+
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            if attention_mask is not None:
+                # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+                attention_scores = attention_scores + attention_mask
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+            # Normalize the attention scores to probabilities.
+            attention_probs = nn.Softmax(dim=-1)(attention_scores)
 
-        if is_cross_attention and self.save_attention:
-            self.save_attention_map(attention_probs)
-            attention_probs.register_hook(self.save_attn_gradients)
+            if is_cross_attention and self.save_attention:
+                self.save_attention_map(attention_probs)
+                attention_probs.register_hook(self.save_attn_gradients)
 
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        attention_probs_dropped = self.dropout(attention_probs)
+            # This is actually dropping out entire tokens to attend to, which might
+            # seem a bit unusual, but is taken from the original Transformer paper.
+            attention_probs_dropped = self.dropout(attention_probs)
 
-        # Mask heads if we want to
-        if head_mask is not None:
-            attention_probs_dropped = attention_probs_dropped * head_mask
+            # Mask heads if we want to
+            if head_mask is not None:
+                attention_probs_dropped = attention_probs_dropped * head_mask
 
-        context_layer = torch.matmul(attention_probs_dropped, value_layer)
+            context_layer = torch.matmul(attention_probs_dropped, value_layer)
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
@@ -898,28 +919,13 @@ class BertModel(BertPreTrainedModel):
 
         # If a 2D or 3D attention mask is provided for the cross-attention
         # we need to make broadcastable to [batch_size, num_heads, seq_length, seq_length]
-        if encoder_hidden_states is not None:
-            if type(encoder_hidden_states) == list:
-                encoder_batch_size, encoder_sequence_length, _ = encoder_hidden_states[
-                    0
-                ].size()
-            else:
-                (
-                    encoder_batch_size,
-                    encoder_sequence_length,
-                    _,
-                ) = encoder_hidden_states.size()
-            encoder_hidden_shape = (encoder_batch_size, encoder_sequence_length)
-
+        # A missing mask means every encoder position is attended to, so no all-zero
+        # additive mask is built and the attention layers skip adding it
+        if encoder_hidden_states is not None and encoder_attention_mask is not None:
             if type(encoder_attention_mask) == list:
                 encoder_extended_attention_mask = [
                     self.invert_attention_mask(mask) for mask in encoder_attention_mask
                 ]
-            elif encoder_attention_mask is None:
-                encoder_attention_mask = torch.ones(encoder_hidden_shape, device=device)
-                encoder_extended_attention_mask = self.invert_attention_mask(
-                    encoder_attention_mask
-                )
             else:
                 encoder_extended_attention_mask = self.invert_attention_mask(
                     encoder_attention_mask
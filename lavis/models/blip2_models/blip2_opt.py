@@ -52,9 +52,15 @@ class Blip2OPT(Blip2Base):
         prompt="",
         max_txt_len=32,
         apply_lemmatizer=False,
+        compile_vision=False,
+        use_compile=False,
+        attn_implementation=None,
     ):
         """
         apply_lemmatizer: when set to True, postprocess predict_answers() result with lemmas.
+        compile_vision: when set to True, run the vision encoder and Q-Former through torch.compile.
+        use_compile: when set to True, run the OPT forward used for the training loss through torch.compile.
+        attn_implementation: attention backend of OPT, e.g. "sdpa" or "flash_attention_2". Uses the transformers default if None.
         """
         super().__init__()
         transformers_version = version.parse(transformers.__version__)
@@ -65,6 +71,8 @@ class Blip2OPT(Blip2Base):
         self.visual_encoder, self.ln_vision = self.init_vision_encoder(
             vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision
         )
+        # the patch embedding conv consumes channels-last images without a layout transpose
+        self.visual_encoder = self.visual_encoder.to(memory_format=torch.channels_last)
         if freeze_vit:
             for name, param in self.visual_encoder.named_parameters():
                 param.requires_grad = False
@@ -82,12 +90,39 @@ class Blip2OPT(Blip2Base):
             layer.output = None
             layer.intermediate = None
 
+        if compile_vision:
+            assert hasattr(torch, "compile"), "compile_vision requires torch>=2.0"
+            # compile bound forwards in place so that state dict keys stay unchanged.
+            # the frozen ViT sees fixed-size images, so cuda graphs are captured for it;
+            # ln_vision is trained and runs eagerly outside that graph.
+            vision_mode = "reduce-overhead" if freeze_vit else "default"
+            self.visual_encoder.forward = torch.compile(
+                self.visual_encoder.forward, mode=vision_mode
+            )
+            self.Qformer.bert.forward = torch.compile(self.Qformer.bert.forward)
+
         self.opt_tokenizer = AutoTokenizer.from_pretrained(opt_model, use_fast=False)
+        opt_kwargs = {}
+        if attn_implementation is not None:
+            opt_kwargs["attn_implementation"] = attn_implementation
         self.opt_model = OPTForCausalLM.from_pretrained(
-            opt_model, torch_dtype=torch.float16
+            opt_model, torch_dtype=torch.float16, **opt_kwargs
         )
         for name, param in self.opt_model.named_parameters():
             param.requires_grad = False
+
+        # only the loss path is compiled, generate() changes the kv-cache shape every step
+        self.use_compile = use_compile
+        self._compiled_opt_forward = None
+        if use_compile:
+            assert hasattr(torch, "compile"), "use_compile requires torch>=2.0"
+            # tokenizers reject truncation lengths that are not a multiple of pad_to_multiple_of
+            assert max_txt_len % 8 == 0, (
+                "use_compile pads text to a multiple of 8, so max_txt_len must be a multiple of 8, got %d"
+                % max_txt_len
+            )
+            self._compiled_opt_forward = torch.compile(self.opt_model.forward)
+
         self.eos_token_id = self.opt_tokenizer(
             "\n", add_special_tokens=False
         ).input_ids[0]
@@ -100,58 +135,127 @@ class Blip2OPT(Blip2Base):
         self.prompt = prompt
         prompt_tokens = self.opt_tokenizer(self.prompt, return_tensors="pt")
         self.prompt_length = prompt_tokens.attention_mask.sum(1)
+        # generate() reuses the default prompt ids instead of re-tokenizing them per call
+        self.register_buffer(
+            "prompt_input_ids",
+            prompt_tokens.input_ids[:, : self.max_txt_len],
+            persistent=False,
+        )
         
+        self._quantized_int8 = False
         self._apply_lemmatizer = apply_lemmatizer
         self._lemmatizer = None       
 
-    def forward(self, samples):
-        image = samples["image"]
+    def _tokenize(self, text, device, **kwargs):
+        """
+        Tokenize text on the CPU and move the tensors to device.
+        On cuda the tensors are pinned and copied with non_blocking=True, so the host
+        does not wait for the vision encoder kernels already queued on the stream.
+        """
+        tokens = self.opt_tokenizer(text, return_tensors="pt", **kwargs)
+        if device.type != "cuda":
+            return tokens.to(device)
+        for key, value in tokens.items():
+            tokens[key] = value.pin_memory().to(device, non_blocking=True)
+        return tokens
+
+    def _prepend_query_embeds(self, inputs_opt, inputs_embeds, attention_mask):
+        """
+        Prepend the projected query tokens to the text embeddings and attention mask.
+        The mask starts as ones and only its text part is copied in, so no separate
+        all-ones mask is allocated for the query tokens.
+        """
+        batch_size, num_query = inputs_opt.size()[:2]
+
+        embeds = torch.cat([inputs_opt, inputs_embeds], dim=1)
+
+        atts = attention_mask.new_ones(batch_size, embeds.size(1))
+        atts[:, num_query:] = attention_mask
+
+        return embeds, atts
+
+    def _encode_image(self, image):
+        """
+        Run the vision encoder, Q-Former and projection, returning the query embeddings fed to OPT.
+        Shared by the training and inference entry points.
+        """
+        image = image.contiguous(memory_format=torch.channels_last)
         with self.maybe_autocast():
             image_embeds = self.ln_vision(self.visual_encoder(image))
-        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-            image.device
-        )
 
-        query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
-        query_output = self.Qformer.bert(
-            query_embeds=query_tokens,
-            encoder_hidden_states=image_embeds,
-            encoder_attention_mask=image_atts,
-            return_dict=True,
-        )
+            query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
+            query_output = self.Qformer.bert(
+                query_embeds=query_tokens,
+                encoder_hidden_states=image_embeds,
+                return_dict=True,
+            )
+
+            inputs_opt = self.opt_proj(query_output.last_hidden_state)
+        return inputs_opt
 
-        inputs_opt = self.opt_proj(query_output.last_hidden_state)
-        atts_opt = torch.ones(inputs_opt.size()[:-1], dtype=torch.long).to(image.device)
+    @torch.inference_mode()
+    def encode_image_for_opt(self, image):
+        """
+        Encode images into the projected query embeddings fed to OPT.
+        The result can be passed to generate() or predict_answers() as samples["inputs_opt"]
+        to skip the vision encoder when the same images are queried repeatedly.
+        """
+        return self._encode_image(image)
 
-        self.opt_tokenizer.padding_side = "right"
+    def _get_inputs_opt(self, samples):
+        """
+        Return the query embeddings precomputed by encode_image_for_opt() if given,
+        e.g. reused across several questions, otherwise encode samples["image"].
+        """
+        if "inputs_opt" in samples.keys():
+            return samples["inputs_opt"]
+        return self._encode_image(samples["image"])
 
-        text = [t + "\n" for t in samples["text_input"]]
+    def forward(self, samples):
+        image = samples["image"]
+        # a single autocast region from the ViT to the LM, so the Q-Former and
+        # projection also run in half precision instead of casting at each boundary
+        with self.maybe_autocast():
+            inputs_opt = self._encode_image(image)
 
-        opt_tokens = self.opt_tokenizer(
-            text,
-            return_tensors="pt",
-            padding="longest",
-            truncation=True,
-            max_length=self.max_txt_len,
-        ).to(image.device)
+            self.opt_tokenizer.padding_side = "right"
 
-        targets = opt_tokens.input_ids.masked_fill(
-            opt_tokens.input_ids == self.opt_tokenizer.pad_token_id, -100
-        )
-        if self.prompt:
-            targets[:, : self.prompt_length] = -100  # do not apply loss to the prompt
+            text = [t + "\n" for t in samples["text_input"]]
 
-        empty_targets = (
-            torch.ones(atts_opt.size(), dtype=torch.long).to(image.device).fill_(-100)
-        )
-        targets = torch.cat([empty_targets, targets], dim=1)
+            opt_tokens = self._tokenize(
+                text,
+                image.device,
+                padding="longest",
+                truncation=True,
+                max_length=self.max_txt_len,
+                # bucket sequence lengths to limit recompilation
+                pad_to_multiple_of=8 if self.use_compile else None,
+            )
+
+            # labels are built in a single buffer, the query tokens and padding get no loss
+            num_query = inputs_opt.size(1)
+            input_ids = opt_tokens.input_ids
+            targets = input_ids.new_full(
+                (input_ids.size(0), num_query + input_ids.size(1)), -100
+            )
+            text_targets = targets[:, num_query:]
+            text_targets.copy_(input_ids)
+            text_targets.masked_fill_(
+                input_ids == self.opt_tokenizer.pad_token_id, -100
+            )
+            if self.prompt:
+                # do not apply loss to the prompt
+                text_targets[:, : self.prompt_length] = -100
 
-        inputs_embeds = self.opt_model.model.decoder.embed_tokens(opt_tokens.input_ids)
-        inputs_embeds = torch.cat([inputs_opt, inputs_embeds], dim=1)
-        attention_mask = torch.cat([atts_opt, opt_tokens.attention_mask], dim=1)
+            inputs_embeds = self.opt_model.model.decoder.embed_tokens(
+                opt_tokens.input_ids
+            )
+            inputs_embeds, attention_mask = self._prepend_query_embeds(
+                inputs_opt, inputs_embeds, opt_tokens.attention_mask
+            )
 
-        with self.maybe_autocast():
-            outputs = self.opt_model(
+            opt_forward = self._compiled_opt_forward or self.opt_model
+            outputs = opt_forward(
                 inputs_embeds=inputs_embeds,
                 attention_mask=attention_mask,
                 return_dict=True,
@@ -161,7 +265,7 @@ class Blip2OPT(Blip2Base):
 
         return {"loss": loss}
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def generate(
         self,
         samples,
@@ -179,55 +283,43 @@ class Blip2OPT(Blip2Base):
         Args:
             samples (dict): A dictionary containing the following keys:
                 - image (torch.Tensor): A tensor of shape (batch_size, 3, H, W)
+                - inputs_opt (torch.Tensor): Optional output of encode_image_for_opt(), used instead of image
             use_nucleus_sampling (bool): Whether to use nucleus sampling. If False, use top-k sampling.
             num_beams (int): Number of beams for beam search. 1 means no beam search.
-            max_length (int): The maximum length of the sequence to be generated.
-            min_length (int): The minimum length of the sequence to be generated.
+            max_length (int): The maximum number of new tokens to be generated, not counting the query tokens and prompt.
+            min_length (int): The minimum number of new tokens to be generated, not counting the query tokens and prompt.
             top_p (float): The cumulative probability for nucleus sampling.
             repetition_penalty (float): The parameter for repetition penalty. 1.0 means no penalty.
             num_captions (int): Number of captions to be generated for each image.
         Returns:
             captions (list): A list of strings of length batch_size * num_captions.
         """
-        image = samples["image"]
         with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image))
-            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-                image.device
-            )
-
-            query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
-            query_output = self.Qformer.bert(
-                query_embeds=query_tokens,
-                encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
-                return_dict=True,
-            )
-
-            inputs_opt = self.opt_proj(query_output.last_hidden_state)
-            atts_opt = torch.ones(inputs_opt.size()[:-1], dtype=torch.long).to(
-                image.device
-            )
+            inputs_opt = self._get_inputs_opt(samples)
+            batch_size, device = inputs_opt.size(0), inputs_opt.device
 
             if "prompt" in samples.keys():
-                prompt = samples["prompt"]
+                prompt = [samples["prompt"]] * batch_size
+
+                opt_tokens = self._tokenize(
+                    prompt,
+                    device,
+                    padding="longest",
+                    truncation=True,
+                    max_length=self.max_txt_len,
+                )
+                prompt_ids = opt_tokens.input_ids
+                prompt_atts = opt_tokens.attention_mask
             else:
-                prompt = self.prompt
-
-            prompt = [prompt] * image.size(0)
-
-            opt_tokens = self.opt_tokenizer(
-                prompt,
-                return_tensors="pt",
-                padding="longest",
-                truncation=True,
-                max_length=self.max_txt_len,
-            ).to(image.device)
-            attention_mask = torch.cat([atts_opt, opt_tokens.attention_mask], dim=1)
+                # the default prompt is the same for every image in the batch
+                prompt_ids = self.prompt_input_ids.expand(batch_size, -1)
+                prompt_atts = torch.ones_like(prompt_ids)
             
             # new version for transformers>=4.27
-            inputs_embeds = self.opt_model.get_input_embeddings()(opt_tokens.input_ids)
-            inputs_embeds = torch.cat([inputs_opt,inputs_embeds],dim=1)
+            inputs_embeds = self.opt_model.get_input_embeddings()(prompt_ids)
+            inputs_embeds, attention_mask = self._prepend_query_embeds(
+                inputs_opt, inputs_embeds, prompt_atts
+            )
             
             outputs = self.opt_model.generate(
                 inputs_embeds=inputs_embeds, 
@@ -236,9 +328,11 @@ class Blip2OPT(Blip2Base):
                 top_p=top_p,
                 temperature=temperature,
                 num_beams=num_beams,
-                max_length=max_length,
-                min_length=min_length,
+                max_new_tokens=max_length,
+                min_new_tokens=min_length,
                 eos_token_id=self.eos_token_id,
+                pad_token_id=self.opt_tokenizer.pad_token_id,
+                use_cache=True,
                 repetition_penalty=repetition_penalty,
                 length_penalty=length_penalty,
                 num_return_sequences=num_captions,
@@ -279,6 +373,7 @@ class Blip2OPT(Blip2Base):
             return output_text
         
         
+    @torch.inference_mode()
     def predict_answers(
         self,
         samples,
@@ -292,25 +387,9 @@ class Blip2OPT(Blip2Base):
         length_penalty=0,
         **kwargs
     ):
-        image = samples["image"]
         with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image))
-            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-                image.device
-            )
-
-            query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
-            query_output = self.Qformer.bert(
-                query_embeds=query_tokens,
-                encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
-                return_dict=True,
-            )
-
-            inputs_opt = self.opt_proj(query_output.last_hidden_state)
-            atts_opt = torch.ones(inputs_opt.size()[:-1], dtype=torch.long).to(
-                image.device
-            )
+            inputs_opt = self._get_inputs_opt(samples)
+            device = inputs_opt.device
 
             if isinstance(samples["text_input"], str):
                 samples["text_input"] = [samples["text_input"]]
@@ -320,19 +399,19 @@ class Blip2OPT(Blip2Base):
                 text_input = samples["text_input"]
 
             self.opt_tokenizer.padding_side = "left"
-            opt_tokens = self.opt_tokenizer(
+            opt_tokens = self._tokenize(
                 text_input,
-                return_tensors="pt",
+                device,
                 padding="longest",
                 truncation=True,
                 max_length=self.max_txt_len,
-            ).to(image.device)
+            )
         
-            attention_mask = torch.cat([atts_opt, opt_tokens.attention_mask], dim=1)
-            
             # require transformers>=4.27
             inputs_embeds = self.opt_model.get_input_embeddings()(opt_tokens.input_ids)
-            inputs_embeds = torch.cat([inputs_opt,inputs_embeds],dim=1)
+            inputs_embeds, attention_mask = self._prepend_query_embeds(
+                inputs_opt, inputs_embeds, opt_tokens.attention_mask
+            )
             
             outputs = self.opt_model.generate(
                 inputs_embeds=inputs_embeds,
@@ -340,8 +419,10 @@ class Blip2OPT(Blip2Base):
                 do_sample=False,
                 num_beams=num_beams,
                 max_new_tokens=max_len,
-                min_length=min_len,
+                min_new_tokens=min_len,
                 eos_token_id=self.eos_token_id,
+                pad_token_id=self.opt_tokenizer.pad_token_id,
+                use_cache=True,
                 length_penalty=length_penalty,
             )
             output_text = self.opt_tokenizer.batch_decode(
@@ -354,9 +435,7 @@ class Blip2OPT(Blip2Base):
         return output_text
     
     def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
+        def apply(doc):
             words = []
             for token in doc:
                 if token.pos_ in ["NOUN", "VERB"]:
@@ -367,7 +446,8 @@ class Blip2OPT(Blip2Base):
 
             return answer
 
-        return [apply(answer) for answer in answers]
+        # run all answers through the spacy pipeline in batches instead of one call per answer
+        return [apply(doc) for doc in self.lemmatizer.pipe(answers, batch_size=64)]
 
     @property
     def lemmatizer(self):
@@ -375,7 +455,10 @@ class Blip2OPT(Blip2Base):
             try:
                 import spacy
 
-                self._lemmatizer = spacy.load("en_core_web_sm")
+                # lemmas only need the tagger, the parser and ner are not used
+                self._lemmatizer = spacy.load(
+                    "en_core_web_sm", disable=["parser", "ner"]
+                )
             except ImportError:
                 logging.error(
                     """
@@ -389,7 +472,37 @@ class Blip2OPT(Blip2Base):
                 exit(1)
 
         return self._lemmatizer
-        
+
+    def quantize_frozen_int8(self):
+        """
+        Apply int8 weight-only quantization to the frozen OPT model and, if frozen, the vision encoder.
+        Embeddings, LayerNorms and the LM head are kept in their original precision.
+        The Q-Former and opt_proj are trained and are left untouched.
+        """
+        try:
+            from torchao.quantization import quantize_, int8_weight_only
+        except ImportError:
+            raise ImportError(
+                "quantize_int8 requires torchao, please install it with: pip install torchao"
+            )
+
+        def filter_fn(module, fqn):
+            return isinstance(module, nn.Linear) and "lm_head" not in fqn
+
+        quantize_(self.opt_model, int8_weight_only(), filter_fn=filter_fn)
+        if not any(p.requires_grad for p in self.visual_encoder.parameters()):
+            quantize_(self.visual_encoder, int8_weight_only(), filter_fn=filter_fn)
+        self._quantized_int8 = True
+        logging.info("quantize frozen weights to int8")
+
+    def float(self):
+        # load_model() casts cpu models to fp32, which is not supported for the int8 weights
+        if self._quantized_int8:
+            raise RuntimeError(
+                "quantize_int8 is only supported on cuda, the quantized model cannot be cast to fp32 for cpu"
+            )
+        return super().float()
+
     @classmethod
     def from_config(cls, cfg):
         vit_model = cfg.get("vit_model", "eva_clip_g")
@@ -406,6 +519,10 @@ class Blip2OPT(Blip2Base):
         max_txt_len = cfg.get("max_txt_len", 32)
         
         apply_lemmatizer = cfg.get("apply_lemmatizer", False)
+        compile_vision = cfg.get("compile_vision", False)
+        use_compile = cfg.get("use_compile", False)
+        quantize_int8 = cfg.get("quantize_int8", False)
+        attn_implementation = cfg.get("attn_implementation", None)
 
         model = cls(
             vit_model=vit_model,
@@ -419,7 +536,14 @@ class Blip2OPT(Blip2Base):
             prompt=prompt,
             max_txt_len=max_txt_len,
             apply_lemmatizer=apply_lemmatizer,
+            compile_vision=compile_vision,
+            use_compile=use_compile,
+            attn_implementation=attn_implementation,
         )
         model.load_checkpoint_from_config(cfg)
 
+        # quantize after loading so that the checkpoint sees the original weights
+        if quantize_int8:
+            model.quantize_frozen_int8()
+
         return model
@@ -0,0 +1,129 @@
+"""
+#
+# Copyright (c) 2023 salesforce.com, inc.
+# All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+#
+
+Unit tests for the Q-Former attention. These run on CPU with a tiny random config.
+"""
+
+import pytest
+import torch
+import torch.nn.functional as F
+from lavis.models.blip2_models.Qformer import BertConfig, BertModel
+
+requires_sdpa = pytest.mark.skipif(
+    not hasattr(F, "scaled_dot_product_attention"),
+    reason="scaled_dot_product_attention requires torch>=2.0",
+)
+
+batch_size = 2
+num_query = 4
+text_len = 6
+num_patches = 5
+encoder_width = 16
+
+
+def build_qformer():
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=100,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=64,
+        max_position_embeddings=64,
+    )
+    config.encoder_width = encoder_width
+    config.add_cross_attention = True
+    config.cross_attention_freq = 1
+    config.query_length = num_query
+    return BertModel(config, add_pooling_layer=False).eval()
+
+
+def padded_mask(length):
+    # second sample is padded on its last two positions
+    mask = torch.ones(batch_size, length, dtype=torch.long)
+    mask[1, -2:] = 0
+    return mask
+
+
+def run_sdpa_and_eager(model, **inputs):
+    # output_attentions=True forces the explicit softmax path in BertSelfAttention
+    with torch.no_grad():
+        sdpa = model(**inputs, output_attentions=False, return_dict=True)
+        eager = model(**inputs, output_attentions=True, return_dict=True)
+    return sdpa.last_hidden_state, eager.last_hidden_state
+
+
+@requires_sdpa
+class TestQformerSdpa:
+    def test_padded_self_attention(self):
+        model = build_qformer()
+        input_ids = torch.randint(1, 100, (batch_size, text_len))
+
+        sdpa, eager = run_sdpa_and_eager(
+            model, input_ids=input_ids, attention_mask=padded_mask(text_len)
+        )
+
+        assert torch.allclose(sdpa, eager, atol=1e-5)
+
+    def test_causal_decoder_mask_with_query(self):
+        model = build_qformer()
+        input_ids = torch.randint(1, 100, (batch_size, text_len))
+
+        sdpa, eager = run_sdpa_and_eager(
+            model,
+            input_ids=input_ids,
+            attention_mask=padded_mask(num_query + text_len),
+            query_embeds=torch.randn(batch_size, num_query, 32),
+            encoder_hidden_states=torch.randn(batch_size, num_patches, encoder_width),
+            is_decoder=True,
+        )
+
+        assert torch.allclose(sdpa, eager, atol=1e-5)
+
+    def test_cross_attention(self):
+        model = build_qformer()
+
+        sdpa, eager = run_sdpa_and_eager(
+            model,
+            query_embeds=torch.randn(batch_size, num_query, 32),
+            encoder_hidden_states=torch.randn(batch_size, num_patches, encoder_width),
+            encoder_attention_mask=padded_mask(num_patches),
+        )
+
+        assert torch.allclose(sdpa, eager, atol=1e-5)
+
+
+class TestQformerEncoderMask:
+    @pytest.mark.parametrize(
+        "output_attentions",
+        [
+            pytest.param(False, marks=requires_sdpa, id="sdpa"),
+            pytest.param(True, id="eager"),
+        ],
+    )
+    def test_none_matches_all_ones(self, output_attentions):
+        model = build_qformer()
+        inputs = dict(
+            query_embeds=torch.randn(batch_size, num_query, 32),
+            encoder_hidden_states=torch.randn(batch_size, num_patches, encoder_width),
+            output_attentions=output_attentions,
+            return_dict=True,
+        )
+
+        with torch.no_grad():
+            without_mask = model(**inputs, encoder_attention_mask=None)
+            all_ones = model(
+                **inputs,
+                encoder_attention_mask=torch.ones(
+                    batch_size, num_patches, dtype=torch.long
+                ),
+            )
+
+        assert torch.allclose(
+            without_mask.last_hidden_state, all_ones.last_hidden_state, atol=1e-6
+        )